@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import pandas as pd
 from tqdm import tqdm
-from analysis.issues_detector import Detector
-from database.neo4j_demo_db import (
-    Neo4JDemoDatabases,
-    Neo4jConnectorSingleton,
+from analysis.issues_detector import (
+    Detector,
+    execution_for_row_with_no_alias_helper,
+    scored_semantics_issues_helper,
 )
+from database.neo4j_demo_db import Neo4JDemoDatabases, Neo4jQueryExecutor
 from utils.constants import DATABASE_REFERENCE_ALIAS, ISSUES_COLUMN_NAME
 from utils.logger import logger_factory
 
@@ -17,15 +20,44 @@ class DatasetIssueAnalyzer:
     @staticmethod
     def add_issue(
         dataset_df: pd.DataFrame,
+        use_logit_scoring: bool = False,
+        fallback_margin: Optional[float] = None,
     ):
         """Add issues to the issues column.
         Args:
             dataset_df: The DataFrame to analyze
             db_alias_2_neo4j_connector: Dict of database aliases to Neo4j connectors
+            use_logit_scoring: Decide the LLM checks by label log-probabilities, batched over all rows, instead of constrained generation per row
+            fallback_margin: Score margin below which a scored decision is re-decided by generation
         Returns:
             DataFrame with issues column populated
         """
-        detector = Detector()
+        detector = Detector(
+            defer_semantics_issues=use_logit_scoring, defer_explain_checks=True
+        )
+        # Rows with no database alias only need EXPLAIN, which any demo database can plan. The checks run concurrently, one worker per pooled connector, so that the pool can spread them
+        neo4j_connector_pool = Neo4JDemoDatabases.create_neo4j_connector_pool()
+        rows_with_no_alias = [
+            row
+            for _, row in dataset_df.iterrows()
+            if row[DATABASE_REFERENCE_ALIAS] is None
+        ]
+        with ThreadPoolExecutor(
+            max_workers=len(neo4j_connector_pool.pooled_connectors)
+        ) as executor:
+            # Each row's issues list is shared with dataset_df, so the helper tags it in place
+            list(
+                tqdm(
+                    executor.map(
+                        lambda row: execution_for_row_with_no_alias_helper(
+                            row, neo4j_connector=neo4j_connector_pool
+                        ),
+                        rows_with_no_alias,
+                    ),
+                    total=len(rows_with_no_alias),
+                    desc="EXPLAIN checks are processing",
+                )
+            )
         # Process the dataset
         for index, row in tqdm(
             dataset_df.iterrows(),
@@ -33,14 +65,18 @@ class DatasetIssueAnalyzer:
             desc=f"Dectector is processing",
         ):
             db_alias = row[DATABASE_REFERENCE_ALIAS]
+            neo4j_connector: Neo4jQueryExecutor
             if db_alias != None:
                 neo4j_connector = Neo4JDemoDatabases.convert_db_alias_to_neo4jconnector(
                     db_alias
                 )
             else:
-                neo4j_connector = Neo4jConnectorSingleton.instance()
+                neo4j_connector = neo4j_connector_pool
             # Detect issues using the detector
             detector.detect_issues(row, neo4j_connector, index, dataset_df)
+        if use_logit_scoring:
+            # Runs after the loop so that the reflection prompts see the updated schemas
+            scored_semantics_issues_helper(dataset_df, fallback_margin=fallback_margin)
         return dataset_df
 
     @staticmethod
@@ -1,19 +1,22 @@
 from enum import Enum
 import re
-from typing import Literal
+from typing import Literal, Optional
 import pandas as pd
-from database.neo4j_demo_db import Neo4jConnector
+from database.neo4j_demo_db import Neo4jQueryExecutor
 from utils.constants import (
     CYPHER,
     DATABASE_REFERENCE_ALIAS,
+    ENDPOINT_UNAVAILABLE_EXCEPTION,
     INSTANCE_ID,
     ISSUES_COLUMN_NAME,
     QUERY_RUN_EXCEPTION,
     QUESTION,
+    REFLECTION_MARGIN_COLUMN_NAME,
     SCHEMA,
+    VAGUENESS_MARGIN_COLUMN_NAME,
 )
 from database.neo4j_demo_db import Neo4JDemoDatabases
-from utils.llm_setup import llm
+from utils.llm_setup import llm, scorer
 from utils.logger import logger_factory
 
 logger = logger_factory(__name__)
@@ -54,7 +57,7 @@ def only_contains_latin_characters_helper(row: pd.Series):
 
 # Rows with database alias could be examined by complete functionality
 def execution_for_row_with_alias_helper(
-    row: pd.Series, neo4j_connector: Neo4jConnector
+    row: pd.Series, neo4j_connector: Neo4jQueryExecutor
 ):
     global logger
     instance_id = row[INSTANCE_ID]
@@ -83,6 +86,18 @@ def execution_for_row_with_alias_helper(
                 issues_column.append(IssueType.EMPTY_RESULT.value)
 
 
+VAGUENESS_LABELS = ("vague", "clear")
+REFLECTION_LABELS = ("yes it reflects", "no it doesn't reflect")
+
+
+def vagueness_prompt(question: str) -> str:
+    return f"determine if the given user question is vague or not: {question}"
+
+
+def reflection_prompt(question: str, cypher_query: str, schema: str) -> str:
+    return f"determine whether given Cypher query semantically reflects the intent of user question or not (schema would be provided but could be useless. you make your choice):\nuser question:\n{question}\nCypher query:\n{cypher_query}\nschema:{schema}"
+
+
 # It would do two things: if the question is ambiguous, tag it with ambiguous_question. If the question is not ambiguous, see if the Cypher query correctly represents the user question by using advanced LLM. This helper is experimental.
 def semantics_issues_helper(row: pd.Series):
     global logger
@@ -93,8 +108,8 @@ def semantics_issues_helper(row: pd.Series):
     issues_column = row[ISSUES_COLUMN_NAME]
     assert isinstance(issues_column, list)
     decision_for_question = llm(
-        f"determine if the given user question is vague or not: {question}",
-        Literal["vague", "clear"],
+        vagueness_prompt(question),
+        Literal[VAGUENESS_LABELS],
     )
 
     if decision_for_question == "vague":
@@ -102,8 +117,8 @@ def semantics_issues_helper(row: pd.Series):
         return
     else:
         decision_for_correctness_of_cypher_query = llm(
-            f"determine whether given Cypher query semantically reflects the intent of user question or not (schema would be provided but could be useless. you make your choice):\nuser question:\n{question}\nCypher query:\n{cypher_query}\nschema:{schema}",
-            Literal["yes it reflects", "no it doesn't reflect"],
+            reflection_prompt(question, cypher_query, schema),
+            Literal[REFLECTION_LABELS],
         )
 
         if decision_for_correctness_of_cypher_query == "no it doesn't reflect":
@@ -111,16 +126,83 @@ def semantics_issues_helper(row: pd.Series):
             return
 
 
+# Decide every prompt between fixed labels by comparing the labels' log-probabilities, batched by the scorer. If fallback_margin is given, decisions whose margin falls below it are re-decided by the slower constrained generation. The score margin of every prompt is returned alongside its decision.
+def scored_decisions_helper(
+    prompts: list[str],
+    labels: tuple[str, ...],
+    fallback_margin: Optional[float] = None,
+) -> list[tuple[str, float]]:
+    decisions = []
+    for prompt, label_score in zip(prompts, scorer.score(prompts, labels)):
+        if fallback_margin is None or label_score.margin >= fallback_margin:
+            decisions.append((label_score.label, label_score.margin))
+        else:
+            logger.info(
+                f"Score margin {label_score.margin:.3f} is below {fallback_margin}, falling back to generation"
+            )
+            decisions.append((llm(prompt, Literal[labels]), label_score.margin))
+    return decisions
+
+
+# Batched counterpart of semantics_issues_helper for the whole dataframe: one scored pass over every question, then one over the queries of the questions judged clear. Schemas must already be updated. Score margins are written to the margin columns, the reflection margin stays empty for vague questions.
+def scored_semantics_issues_helper(
+    dataframe: pd.DataFrame, fallback_margin: Optional[float] = None
+):
+    questions = dataframe[QUESTION].tolist()
+    cypher_queries = dataframe[CYPHER].tolist()
+    schemas = dataframe[SCHEMA].tolist()
+    issues_columns = dataframe[ISSUES_COLUMN_NAME].tolist()
+    reflection_margins: list[Optional[float]] = [None] * len(dataframe)
+
+    decisions_for_questions = scored_decisions_helper(
+        [vagueness_prompt(question) for question in questions],
+        VAGUENESS_LABELS,
+        fallback_margin=fallback_margin,
+    )
+    clear_positions = []
+    for position, (decision, _) in enumerate(decisions_for_questions):
+        if decision == "vague":
+            issues_columns[position].append(IssueType.AMBIGUOUS_QUESTION.value)
+        else:
+            clear_positions.append(position)
+
+    decisions_for_cypher_queries = scored_decisions_helper(
+        [
+            reflection_prompt(
+                questions[position], cypher_queries[position], schemas[position]
+            )
+            for position in clear_positions
+        ],
+        REFLECTION_LABELS,
+        fallback_margin=fallback_margin,
+    )
+    for position, (decision, margin) in zip(
+        clear_positions, decisions_for_cypher_queries
+    ):
+        reflection_margins[position] = margin
+        if decision == "no it doesn't reflect":
+            issues_columns[position].append(IssueType.INACCURATE_QUERY.value)
+
+    dataframe[VAGUENESS_MARGIN_COLUMN_NAME] = [
+        margin for _, margin in decisions_for_questions
+    ]
+    dataframe[REFLECTION_MARGIN_COLUMN_NAME] = reflection_margins
+
+
 # Rows with no database alias would be examined by limited functionality. That being said, only syntax could be checked.
 def execution_for_row_with_no_alias_helper(
-    row: pd.Series, neo4j_connector: Neo4jConnector
+    row: pd.Series, neo4j_connector: Neo4jQueryExecutor
 ):
     cypher_query = row[CYPHER]
     issues_column = row[ISSUES_COLUMN_NAME]
     output, notifications = neo4j_connector.execute_query_with_gql_objects(
         cypher_query=f"EXPLAIN {cypher_query}"
     )
-    if len(output) == 1 and QUERY_RUN_EXCEPTION in output[0]:
+    if len(output) == 1 and ENDPOINT_UNAVAILABLE_EXCEPTION in output[0]:
+        # No endpoint could plan the query, so its syntax remains unchecked
+        logger.warning(f"No Neo4j endpoint could check instance {row[INSTANCE_ID]}")
+        return
+    elif len(output) == 1 and QUERY_RUN_EXCEPTION in output[0]:
         issues_column.append(IssueType.SYNTAX_ERROR.value)
         return
     else:
@@ -131,14 +213,20 @@ def execution_for_row_with_no_alias_helper(
 
 
 class Detector:
-    def __init__(self):
+    def __init__(
+        self, defer_semantics_issues: bool = False, defer_explain_checks: bool = False
+    ):
         self.logger = logger
+        # When set, semantics issues are left to scored_semantics_issues_helper, which batches them over the whole dataframe
+        self.defer_semantics_issues = defer_semantics_issues
+        # When set, the EXPLAIN checks of rows with no database alias are left to the caller, which runs them concurrently
+        self.defer_explain_checks = defer_explain_checks
         super().__init__()
 
     def detect_issues(
         self,
         row: pd.Series,
-        neo4j_connector: Neo4jConnector,
+        neo4j_connector: Neo4jQueryExecutor,
         index,
         dataframe: pd.DataFrame,
     ) -> None:
@@ -148,7 +236,7 @@ class Detector:
         issues_column = row[ISSUES_COLUMN_NAME]
         assert isinstance(issues_column, list)
 
-        """If there is no database alias for this row, this row can only be checked in terms of whether or not the question is vague, whether or not the question contains non-latin characters, syntax (execute the Cypher query against a database with 'EXPLAIN' prepended using a random neo4jconnector)
+        """If there is no database alias for this row, this row can only be checked in terms of whether or not the question is vague, whether or not the question contains non-latin characters, syntax (execute the Cypher query against a database with 'EXPLAIN' prepended using the load-balanced neo4j connector pool)
         
         If the database_reference_alias is null in parquet file, it would be none in dataframe.
         """
@@ -156,13 +244,18 @@ class Detector:
             self.logger.debug(f"db_alias is None for instance {instance_id}")
 
             only_contains_latin_characters_helper(row=row)
-            execution_for_row_with_no_alias_helper(row, neo4j_connector=neo4j_connector)
-            semantics_issues_helper(row=row)
+            if not self.defer_explain_checks:
+                execution_for_row_with_no_alias_helper(
+                    row, neo4j_connector=neo4j_connector
+                )
+            if not self.defer_semantics_issues:
+                semantics_issues_helper(row=row)
             return
         else:
             # Updating schema within issues detector might sound a little bit confusing. But if non-standardized schema is treated as an issue, it somehow makes sense.
             Neo4JDemoDatabases.schema_update(db_alias, index, dataframe=dataframe)
             only_contains_latin_characters_helper(row)
             execution_for_row_with_alias_helper(row, neo4j_connector)
-            semantics_issues_helper(row)
+            if not self.defer_semantics_issues:
+                semantics_issues_helper(row)
             return
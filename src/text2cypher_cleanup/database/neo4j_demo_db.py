@@ -1,8 +1,11 @@
 from enum import Enum
-from typing import LiteralString, Optional, Union, cast
+import threading
+import time
+from typing import Callable, LiteralString, Optional, Protocol, Union, cast
 import neo4j
 import pandas as pd
 from utils.constants import (
+    ENDPOINT_UNAVAILABLE_EXCEPTION,
     FULL_SCHEMA_CYPHER_QUERY,
     NEO4JLABS_DEMO_URI,
     QUERY_RUN_EXCEPTION,
@@ -34,6 +37,14 @@ class DatabaseAliasEnum(str, Enum):
     NEO4JLABS_DEMO_DB_STACKOVERFLOW = "neo4jlabs_demo_db_stackoverflow"
 
 
+class Neo4jQueryExecutor(Protocol):
+    """Anything that runs a query like Neo4jConnector, e.g. Neo4jConnectorPool."""
+
+    def execute_query_with_gql_objects(
+        self, cypher_query: str, params: Optional[dict] = None
+    ) -> tuple[list[dict], list[str]]: ...
+
+
 class Neo4jConnector:
     """Neo4j database connector for executing Cypher queries
     and managing connections."""
@@ -71,24 +82,32 @@ class Neo4jConnector:
         )
         return driver
 
+    def run_query_with_gql_objects(
+        self, cypher_query: str, params: Optional[dict] = None
+    ) -> tuple[list[dict], list[str]]:
+        """Run a query and return its output and notifications, letting exceptions propagate."""
+        with self.driver.session(database=self.db_name) as session:
+            query = neo4j.Query(
+                cast(LiteralString, cypher_query),
+                timeout=self.neo4j_timeout_in_seconds,
+            )
+            intermediate_result = session.run(query=query, parameters=params)
+            output = intermediate_result.data()
+            notifications = [
+                obj.status_description
+                for obj in intermediate_result.consume().gql_status_objects
+            ]
+        return output, notifications
+
     def execute_query_with_gql_objects(
         self, cypher_query: str, params: Optional[dict] = None, for_schema: bool = False
     ):
         if not for_schema:
             self.logger.debug(f"Executing single query on database: {self.db_name}")
             try:
-                with self.driver.session(database=self.db_name) as session:
-                    query = neo4j.Query(
-                        cast(LiteralString, cypher_query),
-                        timeout=self.neo4j_timeout_in_seconds,
-                    )
-                    intermediate_result = session.run(query=query, parameters=params)
-                    output = intermediate_result.data()
-                    notifications = [
-                        obj.status_description
-                        for obj in intermediate_result.consume().gql_status_objects
-                    ]
-
+                output, notifications = self.run_query_with_gql_objects(
+                    cypher_query, params=params
+                )
             except Exception as e:
                 self.logger.warning(f"Exception in execute_query: {e}")
                 output = [{QUERY_RUN_EXCEPTION: type(e).__name__}]
@@ -123,6 +142,175 @@ class Neo4jConnectorSingleton:
         return cls._instance
 
 
+class _PooledNeo4jConnector:
+    """Bookkeeping of one endpoint inside Neo4jConnectorPool."""
+
+    def __init__(self, neo4j_connector: Neo4jConnector) -> None:
+        self.neo4j_connector = neo4j_connector
+        self.outstanding_requests = 0
+        # None until the first response, so that unobserved endpoints are probed first
+        self.latency_ewma: Optional[float] = None
+        self.last_observed_at: Optional[float] = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def is_stale(self, now: float, probe_interval_in_seconds: float) -> bool:
+        return (
+            self.last_observed_at is None
+            or now - self.last_observed_at > probe_interval_in_seconds
+        )
+
+    def load_score(
+        self, now: float, probe_interval_in_seconds: float
+    ) -> tuple[float, int, float]:
+        latency = self.latency_ewma or 0.0
+        # An idle endpoint with a stale (or no) latency is probed again, so that one slow sample doesn't keep it out of rotation forever
+        if self.outstanding_requests == 0 and self.is_stale(
+            now, probe_interval_in_seconds
+        ):
+            latency = 0.0
+        # Outstanding requests, then the oldest observation, break ties
+        return (
+            (self.outstanding_requests + 1) * latency,
+            self.outstanding_requests,
+            (float("-inf") if self.last_observed_at is None else self.last_observed_at),
+        )
+
+
+class Neo4jConnectorPool:
+    """Load-balancing pool for planning-only (EXPLAIN) checks of rows with no database alias. It is thread-safe, so the checks can be sent to it concurrently.
+
+    Every request goes to the healthy connector with the lowest (outstanding requests + 1) * latency EWMA. Idle connectors whose latency wasn't observed for probe_interval_in_seconds are probed first and their EWMA restarts from the fresh sample, so traffic shifts back when the favoured connector slows down. Connectors failing with an endpoint-level exception are ejected from rotation for ejection_in_seconds (doubling on every consecutive failure, up to max_ejection_in_seconds) and the request is retried on at most max_retries other healthy connectors. If no connector answers, the output carries ENDPOINT_UNAVAILABLE_EXCEPTION instead of QUERY_RUN_EXCEPTION. Cypher errors such as syntax errors are regular responses and don't affect health.
+    """
+
+    # Exceptions meaning the endpoint rather than the query is at fault. DriverError also covers connection acquisition timeouts and TransientError covers DatabaseUnavailable, NotALeader and ForbiddenOnReadOnlyDatabase
+    UNHEALTHY_EXCEPTIONS = (
+        neo4j.exceptions.ServiceUnavailable,
+        neo4j.exceptions.SessionExpired,
+        neo4j.exceptions.TransientError,
+        neo4j.exceptions.AuthError,
+        neo4j.exceptions.DriverError,
+        OSError,
+    )
+
+    def __init__(
+        self,
+        neo4j_connectors: list[Neo4jConnector],
+        ejection_in_seconds: float = 30.0,
+        max_ejection_in_seconds: float = 600.0,
+        max_retries: int = 2,
+        latency_smoothing: float = 0.3,
+        probe_interval_in_seconds: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if not neo4j_connectors:
+            raise ValueError("Neo4jConnectorPool needs at least one Neo4j connector")
+        self.logger = logger_factory(self.__class__.__name__)
+        self.pooled_connectors = [
+            _PooledNeo4jConnector(neo4j_connector)
+            for neo4j_connector in neo4j_connectors
+        ]
+        self.ejection_in_seconds = ejection_in_seconds
+        self.max_ejection_in_seconds = max_ejection_in_seconds
+        self.max_retries = max_retries
+        self.latency_smoothing = latency_smoothing
+        self.probe_interval_in_seconds = probe_interval_in_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def _acquire(
+        self, excluded: list[_PooledNeo4jConnector]
+    ) -> Optional[_PooledNeo4jConnector]:
+        with self.lock:
+            now = self.clock()
+            candidates = [
+                pooled for pooled in self.pooled_connectors if pooled not in excluded
+            ]
+            healthy = [pooled for pooled in candidates if pooled.ejected_until <= now]
+            if healthy:
+                chosen = min(
+                    healthy,
+                    key=lambda pooled: pooled.load_score(
+                        now, self.probe_interval_in_seconds
+                    ),
+                )
+            elif not excluded:
+                # Every endpoint is ejected. Keep the checks going on the one that recovers first, but don't retry elsewhere
+                chosen = min(
+                    self.pooled_connectors, key=lambda pooled: pooled.ejected_until
+                )
+            else:
+                return None
+            chosen.outstanding_requests += 1
+            return chosen
+
+    def _release(
+        self, pooled: _PooledNeo4jConnector, latency: float, healthy: bool
+    ) -> None:
+        with self.lock:
+            pooled.outstanding_requests -= 1
+            now = self.clock()
+            if healthy:
+                pooled.consecutive_failures = 0
+                pooled.ejected_until = 0.0
+                # A stale EWMA no longer describes the endpoint, so it restarts from this sample
+                if pooled.latency_ewma is None or pooled.is_stale(
+                    now - latency, self.probe_interval_in_seconds
+                ):
+                    pooled.latency_ewma = latency
+                else:
+                    pooled.latency_ewma += self.latency_smoothing * (
+                        latency - pooled.latency_ewma
+                    )
+                pooled.last_observed_at = now
+            else:
+                pooled.consecutive_failures += 1
+                # The exponent is capped as well, so that a long outage can't overflow it
+                pooled.ejected_until = now + min(
+                    self.ejection_in_seconds
+                    * 2 ** min(pooled.consecutive_failures - 1, 10),
+                    self.max_ejection_in_seconds,
+                )
+                self.logger.warning(
+                    f"Ejecting Neo4j connector for database {pooled.neo4j_connector.db_name} after {pooled.consecutive_failures} consecutive failures"
+                )
+
+    def execute_query_with_gql_objects(
+        self, cypher_query: str, params: Optional[dict] = None
+    ) -> tuple[list[dict], list[str]]:
+        """Same contract as Neo4jConnector.execute_query_with_gql_objects, served by the least loaded healthy connector."""
+        tried: list[_PooledNeo4jConnector] = []
+        endpoint_exception: Optional[Exception] = None
+        for _ in range(self.max_retries + 1):
+            pooled = self._acquire(excluded=tried)
+            if pooled is None:
+                break
+            tried.append(pooled)
+            start = self.clock()
+            try:
+                output, notifications = (
+                    pooled.neo4j_connector.run_query_with_gql_objects(
+                        cypher_query, params=params
+                    )
+                )
+            except self.UNHEALTHY_EXCEPTIONS as e:
+                self._release(pooled, latency=self.clock() - start, healthy=False)
+                endpoint_exception = e
+                continue
+            except Exception as e:
+                # The endpoint answered, the query is at fault
+                self.logger.warning(f"Exception in execute_query: {e}")
+                output = [{QUERY_RUN_EXCEPTION: type(e).__name__}]
+                notifications = []
+            self._release(pooled, latency=self.clock() - start, healthy=True)
+            return output, notifications
+
+        self.logger.warning(
+            f"No Neo4j connector answered after {len(tried)} attempts: {endpoint_exception}"
+        )
+        return [{ENDPOINT_UNAVAILABLE_EXCEPTION: type(endpoint_exception).__name__}], []
+
+
 class Neo4JDemoDatabases:
     LOGGER = logger_factory(__name__)
 
@@ -220,3 +408,18 @@ class Neo4JDemoDatabases:
         return Neo4JDemoDatabases.db_alias_enum_2_neo4jconnector[
             DatabaseAliasEnum(db_alias)
         ]
+
+    @staticmethod
+    def create_neo4j_connector_pool(
+        ejection_in_seconds: float = 30.0,
+    ) -> Neo4jConnectorPool:
+        """Pool every populated demo database connector for the EXPLAIN checks of rows with no database alias, falling back to the northwind singleton."""
+        neo4j_connectors = list(
+            Neo4JDemoDatabases.db_alias_enum_2_neo4jconnector.values()
+        ) or [Neo4jConnectorSingleton.instance()]
+        Neo4JDemoDatabases.LOGGER.info(
+            f"Creating Neo4j connector pool with {len(neo4j_connectors)} connectors"
+        )
+        return Neo4jConnectorPool(
+            neo4j_connectors, ejection_in_seconds=ejection_in_seconds
+        )
@@ -5,7 +5,13 @@ from datasets import Dataset
 from typing import cast
 from analysis.dataset_issues_analyzer import DatasetIssueAnalyzer
 from database.neo4j_demo_db import Neo4JDemoDatabases
-from utils.constants import DATABASE_REFERENCE_ALIAS, ISSUES_COLUMN_NAME
+from utils.constants import (
+    DATABASE_REFERENCE_ALIAS,
+    INSTANCE_ID,
+    ISSUES_COLUMN_NAME,
+    REFLECTION_MARGIN_COLUMN_NAME,
+    VAGUENESS_MARGIN_COLUMN_NAME,
+)
 from datasets import load_dataset
 
 if __name__ == "__main__":
@@ -33,10 +39,23 @@ if __name__ == "__main__":
         neo4j_timeout_in_seconds=30,
     )
 
+    # Logit scoring decides the LLM checks in batched forward passes instead of constrained generation
+    use_logit_scoring = (
+        input("Use logit scoring for LLM checks? y or n: ").strip().lower() == "y"
+    )
+    fallback_margin = None
+    if use_logit_scoring:
+        margin = input(
+            "Score margin below which generation re-decides (empty to disable): "
+        ).strip()
+        fallback_margin = float(margin) if margin else None
+
     print("Starting issue detection")
     print(f"Dataset has {len(text2cypher2024_dataframe)} instances to process")
     output_df = DatasetIssueAnalyzer.add_issue(
         dataset_df=text2cypher2024_dataframe,
+        use_logit_scoring=use_logit_scoring,
+        fallback_margin=fallback_margin,
     )
     print("Processing complete!")
     print(f"Final dataset shape: {output_df.shape}")
@@ -44,10 +63,29 @@ if __name__ == "__main__":
     issue_summary = DatasetIssueAnalyzer.get_issue_summary(output_df)
     print(f"Issue summary: {issue_summary}")
 
+    if use_logit_scoring:
+        # Keep the score margins of every instance, so that thresholds can be chosen from real data
+        output_df[
+            [
+                INSTANCE_ID,
+                ISSUES_COLUMN_NAME,
+                VAGUENESS_MARGIN_COLUMN_NAME,
+                REFLECTION_MARGIN_COLUMN_NAME,
+            ]
+        ].to_parquet(path=OUT_DIR / f"{split}_split_margins.parquet", index=False)
+
     output_dataframe_with_no_issue = output_df[
         output_df[ISSUES_COLUMN_NAME].apply(lambda x: len(x) == 0)
     ]
-    output_dataframe_with_no_issue.drop("issues", axis=1, inplace=True)
+    output_dataframe_with_no_issue.drop(
+        columns=[
+            ISSUES_COLUMN_NAME,
+            VAGUENESS_MARGIN_COLUMN_NAME,
+            REFLECTION_MARGIN_COLUMN_NAME,
+        ],
+        errors="ignore",
+        inplace=True,
+    )
     output_dataframe_with_no_issue.to_parquet(
         path=OUT_DIR / f"{split}_split_cleaned.parquet", index=False
     )
@@ -5,9 +5,14 @@ CYPHER = "cypher"
 INSTANCE_ID = "instance_id"
 QUESTION = "question"
 SCHEMA = "schema"
+# Score margins of the logit-scored LLM checks, only filled in logit scoring mode
+VAGUENESS_MARGIN_COLUMN_NAME = "vagueness_margin"
+REFLECTION_MARGIN_COLUMN_NAME = "reflection_margin"
 
 # Exceptions
 QUERY_RUN_EXCEPTION = "query_run_exception"
+# No Neo4j endpoint could run the query, which says nothing about the query itself
+ENDPOINT_UNAVAILABLE_EXCEPTION = "endpoint_unavailable_exception"
 
 # URI for neo4j demo databases
 NEO4JLABS_DEMO_URI = "neo4j+s://demo.neo4jlabs.com"
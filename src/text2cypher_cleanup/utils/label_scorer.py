@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence, cast
+import torch
+from utils.logger import logger_factory
+
+
+@dataclass
+class LabelScore:
+    """Result of scoring one prompt against a fixed set of candidate labels."""
+
+    label: str
+    # Log-probability gap between the best and the runner-up label.
+    # Small margins mean borderline decisions.
+    margin: float
+    log_probs: dict[str, float]
+
+
+class LogitLabelScorer:
+    """Classifies prompts by comparing next-token log-probabilities of labels.
+
+    Instead of decoding, prompts are scored in batched forward passes and the
+    log-probability of the first token of each label is read off the final
+    position. Labels must therefore start with distinct tokens, e.g. "vague" vs
+    "clear" or "yes it reflects" vs "no it doesn't reflect".
+    """
+
+    def __init__(self, model, tokenizer, batch_size: int = 8) -> None:
+        self.logger = logger_factory(self.__class__.__name__)
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def label_token_ids(self, labels: Sequence[str]) -> list[int]:
+        token_ids = [
+            self.tokenizer(label, add_special_tokens=False).input_ids[0]
+            for label in labels
+        ]
+        if len(set(token_ids)) != len(token_ids):
+            raise ValueError(
+                "Candidate labels must start with distinct tokens to be scored "
+                f"in a single forward pass: {list(labels)}"
+            )
+        return token_ids
+
+    @torch.inference_mode()
+    def score(self, prompts: Sequence[str], labels: Sequence[str]) -> list[LabelScore]:
+        """Score every prompt against the same candidate labels.
+
+        Args:
+            prompts: Prompts to classify, fed to the model as they would be
+                for generation
+            labels: At least two candidate labels
+        Returns:
+            One LabelScore per prompt, in the same order as prompts
+        """
+        if len(labels) < 2:
+            raise ValueError("At least two candidate labels are required")
+        token_ids = self.label_token_ids(labels)
+        scores: list[Optional[LabelScore]] = [None] * len(prompts)
+        # Batching prompts of similar length keeps the padding waste down
+        order = sorted(range(len(prompts)), key=lambda position: len(prompts[position]))
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start : start + self.batch_size]
+            # Left padding keeps the last prompt token at position -1 in every row
+            inputs = self.tokenizer(
+                [prompts[position] for position in positions],
+                return_tensors="pt",
+                padding=True,
+                padding_side="left",
+            ).to(self.model.device)
+            # Positions start at 0 on the first real token, so that padding doesn't
+            # shift a prompt's score depending on the rest of its batch
+            position_ids = (inputs["attention_mask"].cumsum(-1) - 1).clamp(min=0)
+            # Only the last position is needed, so skip the seq_len x vocab logits
+            logits = self.model(
+                **inputs, position_ids=position_ids, logits_to_keep=1
+            ).logits[:, -1, :]
+            label_log_probs = torch.log_softmax(logits.float(), dim=-1)[:, token_ids]
+            for position, row in zip(positions, label_log_probs.tolist()):
+                ranked = sorted(
+                    zip(labels, row), key=lambda pair: pair[1], reverse=True
+                )
+                scores[position] = LabelScore(
+                    label=ranked[0][0],
+                    margin=ranked[0][1] - ranked[1][1],
+                    log_probs=dict(zip(labels, row)),
+                )
+        self.logger.debug(
+            f"Scored {len(prompts)} prompts against labels {list(labels)}"
+        )
+        return cast(list[LabelScore], scores)
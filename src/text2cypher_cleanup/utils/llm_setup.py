@@ -1,6 +1,7 @@
 import outlines
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
+from utils.label_scorer import LogitLabelScorer
 
 import getpass
 import os
@@ -17,3 +18,6 @@ mdl = AutoModelForCausalLM.from_pretrained(
 )
 
 llm = outlines.from_transformers(mdl, tok)
+
+# Single forward pass label scoring for binary checks, an alternative to constrained generation
+scorer = LogitLabelScorer(mdl, tok)
@@ -1,13 +1,28 @@
+import sys
+import threading
+import time
+import types
 import unittest
 from unittest.mock import patch, MagicMock
 import logging
+import pandas as pd
+import torch
+from neo4j.exceptions import (
+    ConnectionAcquisitionTimeoutError,
+    CypherSyntaxError,
+    ForbiddenOnReadOnlyDatabase,
+    NotALeader,
+    ServiceUnavailable,
+)
 from src.text2cypher_cleanup.database.neo4j_demo_db import (
     DatabaseAliasEnum,
     Neo4jConnector,
+    Neo4jConnectorPool,
     Neo4jConnectorSingleton,
     Neo4JDemoDatabases,
 )
 from src.text2cypher_cleanup.utils import constants, logger
+from src.text2cypher_cleanup.utils.label_scorer import LabelScore, LogitLabelScorer
 
 
 class TestNeo4jDemoDB(unittest.TestCase):
@@ -58,6 +73,259 @@ class TestNeo4jDemoDB(unittest.TestCase):
         self.assertTrue(Neo4JDemoDatabases.db_alias_enum_2_neo4jconnector)
 
 
+# issues_detector loads the local LLM through utils.llm_setup, which is replaced by a stub for the tests
+_llm_setup_stub = types.ModuleType("utils.llm_setup")
+_llm_setup_stub.llm = MagicMock()
+_llm_setup_stub.scorer = MagicMock()
+with patch.dict(sys.modules, {"utils.llm_setup": _llm_setup_stub}):
+    from analysis import dataset_issues_analyzer, issues_detector
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class InFlightCounter:
+    """Counts queries running at the same time across fake drivers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.current -= 1
+
+
+class FakeNeo4jDriver:
+    """Local stand-in for neo4j.Driver whose queries take a fixed latency, on a shared fake clock or, without one, in real time."""
+
+    def __init__(self, clock, latency, error=None, in_flight=None):
+        self.clock = clock
+        self.latency = latency
+        self.error = error
+        self.in_flight = in_flight or InFlightCounter()
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def session(self, database=None):
+        session = MagicMock()
+        session.__enter__.return_value.run.side_effect = self._run
+        return session
+
+    def _run(self, query, parameters=None):
+        with self.lock:
+            self.queries += 1
+        with self.in_flight:
+            if self.clock is None:
+                time.sleep(self.latency)
+            else:
+                self.clock.now += self.latency
+        if self.error is not None:
+            raise self.error
+        if "BROKEN" in query.text:
+            raise CypherSyntaxError("Invalid input")
+        result = MagicMock()
+        result.data.return_value = []
+        result.consume.return_value.gql_status_objects = []
+        return result
+
+
+class TestNeo4jConnectorPool(unittest.TestCase):
+    def _pool(self, drivers, clock, **pool_kwargs):
+        connectors = []
+        for db_name, driver in drivers.items():
+            with patch(
+                "src.text2cypher_cleanup.database.neo4j_demo_db.neo4j.GraphDatabase.driver",
+                return_value=driver,
+            ):
+                connectors.append(
+                    Neo4jConnector(
+                        "neo4j+s://demo.neo4jlabs.com", db_name, db_name, db_name
+                    )
+                )
+        return Neo4jConnectorPool(
+            connectors, ejection_in_seconds=10.0, clock=clock, **pool_kwargs
+        )
+
+    def test_prefers_lower_latency_endpoint(self):
+        clock = FakeClock()
+        fast = FakeNeo4jDriver(clock, latency=0.01)
+        slow = FakeNeo4jDriver(clock, latency=0.5)
+        pool = self._pool({"movies": slow, "northwind": fast}, clock)
+        for _ in range(20):
+            pool.execute_query_with_gql_objects("EXPLAIN MATCH (n) RETURN n")
+        self.assertEqual(slow.queries, 1)
+        self.assertEqual(fast.queries, 19)
+
+    def test_traffic_shifts_back_when_favoured_endpoint_slows_down(self):
+        clock = FakeClock()
+        favoured = FakeNeo4jDriver(clock, latency=0.05)
+        # A transient spike during its first probe makes this endpoint look slow
+        other = FakeNeo4jDriver(clock, latency=0.5)
+        pool = self._pool({"movies": other, "northwind": favoured}, clock)
+        for _ in range(10):
+            pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+        self.assertEqual(other.queries, 1)
+
+        favoured.latency = 0.2
+        other.latency = 0.02
+        for _ in range(100):
+            pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+        # The stale measurement is re-probed and the rest of the traffic follows it
+        self.assertGreater(other.queries, 50)
+        queries_before = other.queries
+        for _ in range(20):
+            pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+        self.assertEqual(other.queries, queries_before + 20)
+
+    def test_add_issue_runs_explain_checks_concurrently(self):
+        in_flight = InFlightCounter()
+        drivers = {
+            db_name: FakeNeo4jDriver(None, latency=0.05, in_flight=in_flight)
+            for db_name in ("movies", "northwind", "twitter")
+        }
+        pool = self._pool(drivers, time.monotonic)
+        cypher_queries = ["MATCH (n) RETURN count(n)"] * 8 + ["MATCH (n RETURN BROKEN"]
+        dataframe = pd.DataFrame(
+            {
+                constants.INSTANCE_ID: [f"instance-{i}" for i in range(9)],
+                constants.DATABASE_REFERENCE_ALIAS: [None] * 9,
+                constants.QUESTION: ["How many nodes are there?"] * 9,
+                constants.CYPHER: cypher_queries,
+                constants.SCHEMA: ["schema"] * 9,
+                constants.ISSUES_COLUMN_NAME: [[] for _ in range(9)],
+            }
+        )
+        scorer = MagicMock()
+        scorer.score.side_effect = lambda prompts, labels: [
+            LabelScore(
+                label=labels[1] if "clear" in labels else labels[0],
+                margin=1.0,
+                log_probs={},
+            )
+            for _ in prompts
+        ]
+        with (
+            patch.object(
+                dataset_issues_analyzer.Neo4JDemoDatabases,
+                "create_neo4j_connector_pool",
+                return_value=pool,
+            ),
+            patch.object(issues_detector, "scorer", scorer),
+        ):
+            dataset_issues_analyzer.DatasetIssueAnalyzer.add_issue(
+                dataframe, use_logit_scoring=True
+            )
+
+        self.assertGreater(in_flight.peak, 1)
+        # Least outstanding requests spreads the concurrent checks over every connector
+        for driver in drivers.values():
+            self.assertGreater(driver.queries, 0)
+        # Each row is checked once, the deferred detector doesn't repeat it
+        self.assertEqual(sum(driver.queries for driver in drivers.values()), 9)
+        self.assertEqual(
+            dataframe[constants.ISSUES_COLUMN_NAME].tolist(),
+            [[]] * 8 + [[issues_detector.IssueType.SYNTAX_ERROR.value]],
+        )
+
+    def test_unhealthy_endpoint_is_ejected_and_retried_elsewhere(self):
+        clock = FakeClock()
+        down = FakeNeo4jDriver(clock, latency=0.01, error=ServiceUnavailable("down"))
+        up = FakeNeo4jDriver(clock, latency=0.2)
+        pool = self._pool({"movies": down, "northwind": up}, clock)
+        for _ in range(5):
+            output, _ = pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+            self.assertEqual(output, [])
+        self.assertEqual(down.queries, 1)
+        self.assertEqual(up.queries, 5)
+
+        # After the ejection window the endpoint is probed again
+        clock.now += 11.0
+        pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+        self.assertEqual(down.queries, 2)
+
+    def test_endpoint_errors_are_classified_by_exception_type(self):
+        for error in (
+            ConnectionAcquisitionTimeoutError("pool is full"),
+            NotALeader("not a leader"),
+            ForbiddenOnReadOnlyDatabase("read only"),
+            ConnectionResetError("reset by peer"),
+        ):
+            with self.subTest(error=type(error).__name__):
+                clock = FakeClock()
+                pool = self._pool(
+                    {"northwind": FakeNeo4jDriver(clock, latency=0.01, error=error)},
+                    clock,
+                )
+                pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+                self.assertEqual(pool.pooled_connectors[0].consecutive_failures, 1)
+
+    def test_syntax_errors_do_not_eject(self):
+        clock = FakeClock()
+        pool = self._pool({"northwind": FakeNeo4jDriver(clock, latency=0.01)}, clock)
+        output, _ = pool.execute_query_with_gql_objects(
+            "EXPLAIN MATCH (n RETURN BROKEN"
+        )
+        self.assertEqual(output, [{constants.QUERY_RUN_EXCEPTION: "CypherSyntaxError"}])
+        self.assertEqual(pool.pooled_connectors[0].consecutive_failures, 0)
+
+    def test_outage_is_not_a_syntax_error_and_retries_are_bounded(self):
+        clock = FakeClock()
+        drivers = {
+            db_name: FakeNeo4jDriver(
+                clock, latency=0.01, error=ServiceUnavailable("down")
+            )
+            for db_name in ("movies", "northwind", "twitter", "twitch")
+        }
+        pool = self._pool(drivers, clock, max_retries=2)
+        row = pd.Series(
+            {
+                constants.INSTANCE_ID: "instance-1",
+                constants.CYPHER: "MATCH (n) RETURN n",
+                constants.ISSUES_COLUMN_NAME: [],
+            }
+        )
+
+        issues_detector.execution_for_row_with_no_alias_helper(row, pool)
+
+        self.assertEqual(row[constants.ISSUES_COLUMN_NAME], [])
+        self.assertEqual(sum(driver.queries for driver in drivers.values()), 3)
+        output, _ = pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+        self.assertEqual(
+            output, [{constants.ENDPOINT_UNAVAILABLE_EXCEPTION: "ServiceUnavailable"}]
+        )
+        # With every endpoint ejected, a row costs a single attempt
+        self.assertEqual(sum(driver.queries for driver in drivers.values()), 4)
+
+    def test_ejection_backoff_is_capped(self):
+        clock = FakeClock()
+        pool = self._pool(
+            {
+                "northwind": FakeNeo4jDriver(
+                    clock, latency=0.01, error=ServiceUnavailable("down")
+                )
+            },
+            clock,
+            max_ejection_in_seconds=600.0,
+        )
+        for _ in range(1100):
+            pool.execute_query_with_gql_objects("EXPLAIN RETURN 1")
+        pooled = pool.pooled_connectors[0]
+        self.assertEqual(pooled.consecutive_failures, 1100)
+        self.assertLessEqual(pooled.ejected_until - clock.now, 600.0)
+
+
 class TestConstants(unittest.TestCase):
     def test_constants_exist(self):
         self.assertEqual(constants.ISSUES_COLUMN_NAME, "issues")
@@ -76,5 +344,193 @@ class TestLogger(unittest.TestCase):
         self.assertTrue(log)
 
 
+class FakeBatchEncoding(dict):
+    def to(self, device):
+        return self
+
+
+class FakeTokenizer:
+    """Left-pads batches like the real tokenizer call, one token per word of a prompt."""
+
+    pad_token = "<pad>"
+
+    def __init__(self, label_token_ids):
+        self.label_token_ids = label_token_ids
+        self.batch_kwargs = []
+
+    def __call__(self, text, **kwargs):
+        if isinstance(text, str):
+            return MagicMock(input_ids=[self.label_token_ids[text]])
+        self.batch_kwargs.append(kwargs)
+        lengths = [len(prompt.split()) for prompt in text]
+        width = max(lengths)
+        attention_mask = torch.tensor(
+            [[0] * (width - length) + [1] * length for length in lengths]
+        )
+        return FakeBatchEncoding(prompts=text, attention_mask=attention_mask)
+
+
+class TestLogitLabelScorer(unittest.TestCase):
+    def _scorer(self, last_logits, batch_size=8):
+        """last_logits maps every prompt to its logits over the vocabulary [pad, vague, clear]"""
+        model = MagicMock()
+        model.side_effect = lambda prompts, **kwargs: MagicMock(
+            logits=torch.tensor([last_logits[p] for p in prompts]).unsqueeze(1)
+        )
+        tokenizer = FakeTokenizer({"vague": 1, "clear": 2, "yes a": 1, "yes b": 1})
+        return LogitLabelScorer(model, tokenizer, batch_size=batch_size), model
+
+    def test_score_picks_label_and_margin(self):
+        scorer, _ = self._scorer({"q1": [0.0, 3.0, 1.0], "q2": [0.0, 0.0, 2.0]})
+        scores = scorer.score(["q1", "q2"], ("vague", "clear"))
+        self.assertEqual([score.label for score in scores], ["vague", "clear"])
+        self.assertAlmostEqual(scores[0].margin, 2.0, places=5)
+        self.assertAlmostEqual(scores[1].margin, 2.0, places=5)
+
+    def test_prompts_beyond_batch_size_are_chunked_by_length(self):
+        prompts = ["a b c d e", "a", "a b c", "a b", "a b c d"]
+        last_logits = {
+            prompt: [0.0, float(i % 2), float((i + 1) % 2)]
+            for i, prompt in enumerate(prompts)
+        }
+        scorer, model = self._scorer(last_logits, batch_size=2)
+
+        scores = scorer.score(prompts, ("vague", "clear"))
+
+        # Results come back in the order of the prompts
+        self.assertEqual(
+            [score.label for score in scores],
+            ["clear", "vague", "clear", "vague", "clear"],
+        )
+        self.assertEqual(
+            [call.kwargs["prompts"] for call in model.call_args_list],
+            [["a", "a b"], ["a b c", "a b c d"], ["a b c d e"]],
+        )
+        for call in model.call_args_list:
+            self.assertEqual(call.kwargs["logits_to_keep"], 1)
+        for kwargs in scorer.tokenizer.batch_kwargs:
+            self.assertEqual(kwargs["padding_side"], "left")
+
+    def test_position_ids_skip_left_padding(self):
+        scorer, model = self._scorer({"a b c": [0.0, 1.0, 0.0], "a": [0.0, 0.0, 1.0]})
+        scorer.score(["a b c", "a"], ("vague", "clear"))
+        self.assertEqual(
+            model.call_args.kwargs["position_ids"].tolist(), [[0, 0, 0], [0, 1, 2]]
+        )
+
+    def test_labels_sharing_first_token_are_rejected(self):
+        scorer, _ = self._scorer({"q": [0.0, 1.0, 0.0]})
+        with self.assertRaises(ValueError):
+            scorer.score(["q"], ("yes a", "yes b"))
+
+
+class TestScoredSemanticsIssues(unittest.TestCase):
+    def setUp(self):
+        self.scorer = MagicMock()
+        self.llm = MagicMock()
+        for name, stub in (("scorer", self.scorer), ("llm", self.llm)):
+            patcher = patch.object(issues_detector, name, stub)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _dataframe(self, questions):
+        return pd.DataFrame(
+            {
+                constants.QUESTION: questions,
+                constants.CYPHER: [f"MATCH (n) RETURN n // {q}" for q in questions],
+                constants.SCHEMA: ["schema"] * len(questions),
+                constants.ISSUES_COLUMN_NAME: [[] for _ in questions],
+            },
+            # Issues have to land by position, whatever the index is
+            index=[30, 10, 20][: len(questions)],
+        )
+
+    def _score_by_prompt(self, decisions):
+        """decisions maps a substring of a prompt to (label, margin)"""
+
+        def score(prompts, labels):
+            scores = []
+            for prompt in prompts:
+                label, margin = next(
+                    decision
+                    for needle, decision in decisions.items()
+                    if needle in prompt
+                )
+                scores.append(LabelScore(label=label, margin=margin, log_probs={}))
+            return scores
+
+        self.scorer.score.side_effect = score
+
+    def test_vague_rows_skip_reflection_and_issues_land_by_position(self):
+        dataframe = self._dataframe(["vague one", "clear wrong", "clear right"])
+        self._score_by_prompt(
+            {
+                "vague or not: vague one": ("vague", 2.0),
+                "vague or not: clear": ("clear", 3.0),
+                "// clear wrong": ("no it doesn't reflect", 1.0),
+                "// clear right": ("yes it reflects", 4.0),
+            }
+        )
+
+        issues_detector.scored_semantics_issues_helper(dataframe)
+
+        vagueness_call, reflection_call = self.scorer.score.call_args_list
+        self.assertEqual(len(vagueness_call.args[0]), 3)
+        self.assertEqual(len(reflection_call.args[0]), 2)
+        self.assertFalse(
+            any("vague one" in prompt for prompt in reflection_call.args[0])
+        )
+        self.assertEqual(
+            dataframe[constants.ISSUES_COLUMN_NAME].tolist(),
+            [
+                [issues_detector.IssueType.AMBIGUOUS_QUESTION.value],
+                [issues_detector.IssueType.INACCURATE_QUERY.value],
+                [],
+            ],
+        )
+        self.assertEqual(
+            dataframe[constants.VAGUENESS_MARGIN_COLUMN_NAME].tolist(), [2.0, 3.0, 3.0]
+        )
+        reflection_margins = dataframe[constants.REFLECTION_MARGIN_COLUMN_NAME]
+        self.assertTrue(pd.isna(reflection_margins.iloc[0]))
+        self.assertEqual(reflection_margins.iloc[1:].tolist(), [1.0, 4.0])
+        self.llm.assert_not_called()
+
+    def test_decisions_below_margin_fall_back_to_generation(self):
+        self._score_by_prompt({"certain": ("clear", 5.0), "borderline": ("clear", 0.1)})
+        self.llm.return_value = "vague"
+
+        decisions = issues_detector.scored_decisions_helper(
+            ["certain", "borderline"], ("vague", "clear"), fallback_margin=1.0
+        )
+
+        self.assertEqual(decisions, [("clear", 5.0), ("vague", 0.1)])
+        self.llm.assert_called_once()
+        self.assertEqual(self.llm.call_args.args[0], "borderline")
+
+    def test_deferred_detector_does_not_run_semantics_per_row(self):
+        row = pd.Series(
+            {
+                constants.INSTANCE_ID: "instance-1",
+                constants.DATABASE_REFERENCE_ALIAS: None,
+                constants.QUESTION: "How many nodes are there?",
+                constants.CYPHER: "MATCH (n) RETURN count(n)",
+                constants.SCHEMA: "schema",
+                constants.ISSUES_COLUMN_NAME: [],
+            }
+        )
+        neo4j_connector = MagicMock()
+        neo4j_connector.execute_query_with_gql_objects.return_value = ([], [])
+        with patch.object(issues_detector, "semantics_issues_helper") as per_row:
+            issues_detector.Detector(defer_semantics_issues=True).detect_issues(
+                row, neo4j_connector, 0, pd.DataFrame()
+            )
+            per_row.assert_not_called()
+            issues_detector.Detector().detect_issues(
+                row, neo4j_connector, 0, pd.DataFrame()
+            )
+            per_row.assert_called_once()
+
+
 if __name__ == "__main__":
     unittest.main()